@@ -5,13 +5,37 @@
 import os
 import logging
 import io
+import base64
+import asyncio
+import functools
+import hmac
+import hashlib
+import json
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import importlib.util
 import torch
-from fastapi import FastAPI, Request, Header, HTTPException, UploadFile, File
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from transformers import pipeline
+import httpx
+from fastapi import FastAPI, Request, Header, HTTPException, UploadFile, File, Form, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from transformers import (
+    pipeline,
+    TextIteratorStreamer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    StopStringCriteria,
+    AutoImageProcessor,
+    AutoModelForCausalLM,
+    AutoModelForImageClassification,
+)
 from PIL import Image
-from vector import query_vector
+from torchvision.io import decode_jpeg, ImageReadMode
+from torchvision.transforms import v2
+from vector import query_vectors, get_encoder, get_vector_store, configure_device
 
 # ==============================
 # Logging Setup
@@ -22,25 +46,48 @@ logger = logging.getLogger("AgriCopilot")
 # ==============================
 # FastAPI App Init
 # ==============================
-app = FastAPI(title="AgriCopilot")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts the batchers and model loading; on shutdown stops them and closes clients and pools."""
+    tasks = [asyncio.create_task(vector_query_batcher()), asyncio.create_task(load_models())]
+    if llm_client is None:
+        tasks.append(asyncio.create_task(generation_batcher()))
+    if vlm_client is None:
+        tasks.append(asyncio.create_task(vision_batcher()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in (llm_client, vlm_client, redis_client):
+            if client is not None:
+                await client.aclose()
+        inference_executor.shutdown(wait=False, cancel_futures=True)
+        llm_executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(title="AgriCopilot", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 @app.get("/")
 async def root():
-    return {"status": "✅ AgriCopilot AI Backend is running and stable."}
+    return {"status": "✅ AgriCopilot AI Backend is running and stable.", "models_ready": models_ready.is_set()}
 
 # ==============================
 # Auth Config
 # ==============================
 PROJECT_API_KEY = os.getenv("PROJECT_API_KEY", "agricopilot404")
+BEARER_PREFIX = b"Bearer "
+EXPECTED_AUTH = BEARER_PREFIX + PROJECT_API_KEY.encode()
 
-def check_auth(authorization: str | None):
-    """Verifies Bearer token for all requests."""
+async def require_auth(authorization: str | None = Header(None)):
+    """Verifies the Bearer token; attached to routes as a dependency (async, so no threadpool hop)."""
     if not PROJECT_API_KEY:
         return
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = authorization.split(" ", 1)[1]
-    if token != PROJECT_API_KEY:
+    # 401 when no bearer credentials were sent at all, 403 when the token is wrong
+    supplied = (authorization or "").encode()
+    if not hmac.compare_digest(supplied[:len(BEARER_PREFIX)], BEARER_PREFIX):
+        raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+    if not hmac.compare_digest(supplied, EXPECTED_AUTH):
         raise HTTPException(status_code=403, detail="Invalid token")
 
 # ==============================
@@ -49,23 +96,43 @@ def check_auth(authorization: str | None):
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled error: {exc}")
-    return JSONResponse(status_code=500, content={"error": str(exc)})
+    return ORJSONResponse(status_code=500, content={"error": str(exc)})
 
 # ==============================
 # Request Schemas
 # ==============================
 class ChatRequest(BaseModel):
     query: str
+    stream: bool = False
+    max_tokens: int | None = Field(None, ge=1)
 
 class DisasterRequest(BaseModel):
     report: str
+    stream: bool = False
+    max_tokens: int | None = Field(None, ge=1)
 
 class MarketRequest(BaseModel):
     product: str
+    stream: bool = False
+    max_tokens: int | None = Field(None, ge=1)
 
 class VectorRequest(BaseModel):
     query: str
 
+class CropDoctorForm(BaseModel):
+    symptoms: str
+
+    @classmethod
+    async def as_form(
+        cls,
+        symptoms: str | None = Form(None),
+        symptoms_header: str | None = Header(None, alias="symptoms"),
+    ) -> "CropDoctorForm":
+        """Reads symptoms from the multipart body, falling back to the legacy header."""
+        if symptoms is None and symptoms_header is None:
+            raise HTTPException(status_code=422, detail="symptoms is required")
+        return cls(symptoms=symptoms if symptoms is not None else symptoms_header)
+
 # ==============================
 # Hugging Face Config
 # ==============================
@@ -76,93 +143,726 @@ if not HF_TOKEN:
 else:
     logger.info("✅ Hugging Face token detected.")
 
-# Device setup (GPU if available)
-device = 0 if torch.cuda.is_available() else -1
-logger.info(f"🧠 Using device: {'GPU' if device == 0 else 'CPU'}")
+# Device setup (GPU if available). Each worker pins itself to one GPU: WORKER_GPU
+# when set, otherwise pid modulo the GPU count. uvicorn worker pids are not
+# consecutive, so the pid spread is best-effort and may put two workers on one
+# GPU; pin with WORKER_GPU or CUDA_VISIBLE_DEVICES when running several workers.
+device = -1
+if torch.cuda.is_available():
+    device = int(os.getenv("WORKER_GPU", os.getpid() % torch.cuda.device_count()))
+    torch.cuda.set_device(device)
+logger.info(f"🧠 Using device: {f'GPU {device}' if device >= 0 else 'CPU'}")
+torch_device = f"cuda:{device}" if device >= 0 else "cpu"
+# The knowledge-base encoder shares the worker's GPU
+configure_device(torch_device)
+
+# Inference only: no autograd bookkeeping, and TF32 tensor cores for any fp32 matmuls
+torch.set_grad_enabled(False)
+torch.set_float32_matmul_precision("high")
+
+# bf16 and FlashAttention-2 need Ampere (compute capability 8.0) or newer; older
+# GPUs such as the T4 and V100 run fp16 with SDPA, and the CPU stays in fp32
+ampere_or_newer = device >= 0 and torch.cuda.get_device_capability(device) >= (8, 0)
+torch_dtype = torch.bfloat16 if ampere_or_newer else torch.float16 if device >= 0 else torch.float32
+attn_implementation = (
+    "flash_attention_2" if ampere_or_newer and importlib.util.find_spec("flash_attn") else "sdpa"
+)
 
 # ==============================
-# Pipelines
+# LLM Backend
 # ==============================
-# Conversational + reasoning models (Meta LLaMA)
-chat_pipe = pipeline(
-    "text-generation",
-    model="meta-llama/Llama-3.1-8B-Instruct",
-    token=HF_TOKEN,
-    device=device,
-)
+# When LLM_SERVER_URL points at an OpenAI-compatible server (e.g. a vLLM
+# sidecar), generation is forwarded there so the weights are loaded once and
+# concurrent requests are batched by the server. Otherwise the model is loaded
+# in-process.
+DEFAULT_LLM_MODEL = "meta-llama/Llama-3.1-8B-Instruct"
+LLM_MODEL = os.getenv("LLM_MODEL", DEFAULT_LLM_MODEL)
+LLM_SERVER_URL = os.getenv("LLM_SERVER_URL")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+# Pre-quantized checkpoints used in-process: FP8 on Ada/Hopper GPUs (needs
+# compressed-tensors), INT4-AWQ on other GPUs (needs autoawq). The defaults are
+# quantizations of the default model, so with a custom LLM_MODEL they are only
+# used when set explicitly.
+_default_quantized = LLM_MODEL == DEFAULT_LLM_MODEL
+LLM_FP8_MODEL = os.getenv("LLM_FP8_MODEL", "neuralmagic/Meta-Llama-3.1-8B-Instruct-FP8" if _default_quantized else None)
+LLM_AWQ_MODEL = os.getenv("LLM_AWQ_MODEL", "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4" if _default_quantized else None)
+# torch.compile the in-process model on GPU (set to 0 to skip the startup compile)
+LLM_COMPILE = os.getenv("LLM_COMPILE", "1") == "1"
+# Optional small draft model for speculative decoding of greedy generations
+LLM_DRAFT_MODEL = os.getenv("LLM_DRAFT_MODEL")
 
-disaster_pipe = pipeline(
-    "text-generation",
-    model="meta-llama/Llama-3.1-8B-Instruct",
-    token=HF_TOKEN,
-    device=device,
-)
+# Optional vision-LLM server; when set, /crop-doctor sends the image itself in a
+# single call instead of chaining ConvNeXt -> vector search -> LLaMA.
+VLM_SERVER_URL = os.getenv("VLM_SERVER_URL")
+VLM_MODEL = os.getenv("VLM_MODEL", "meta-llama/Llama-3.2-11B-Vision-Instruct")
+vlm_client = httpx.AsyncClient(base_url=VLM_SERVER_URL, timeout=LLM_TIMEOUT) if VLM_SERVER_URL else None
 
-market_pipe = pipeline(
-    "text-generation",
-    model="meta-llama/Llama-3.1-8B-Instruct",
-    token=HF_TOKEN,
-    device=device,
-)
+llm_client = httpx.AsyncClient(base_url=LLM_SERVER_URL, timeout=LLM_TIMEOUT) if LLM_SERVER_URL else None
+if llm_client is not None:
+    logger.info(f"🔗 Forwarding generation to LLM server at {LLM_SERVER_URL}")
 
-# Lightweight Meta Vision backbone (ConvNeXt-Tiny)
-crop_vision = pipeline(
-    "image-classification",
-    model="facebook/convnext-tiny-224",
-    token=HF_TOKEN,
-    device=device,
-)
+# In-process models are loaded by load_models() after startup (see Model Loading)
+llm_pipe = None
+draft_model = None
+llm_stopping_criteria = None
+# Model that actually generates replies (load_llm may pick a quantized checkpoint);
+# part of the reply cache keys so a model swap never serves stale replies
+llm_model_id = LLM_MODEL
+
+def load_llm():
+    """Loads the shared in-process LLaMA pipeline and applies the GPU optimizations."""
+    global llm_pipe, draft_model, llm_stopping_criteria, llm_model_id
+    # Decode is bound by weight bandwidth, so FP8 (half) or INT4 (quarter) weights
+    # cut the bytes read per token. FP8 tensor cores need compute capability 8.9+.
+    model_id, llm_dtype = LLM_MODEL, torch_dtype
+    if LLM_FP8_MODEL and device >= 0 and torch.cuda.get_device_capability(device) >= (8, 9) and importlib.util.find_spec("compressed_tensors"):
+        model_id = LLM_FP8_MODEL
+    elif LLM_AWQ_MODEL and device >= 0 and importlib.util.find_spec("awq"):
+        model_id, llm_dtype = LLM_AWQ_MODEL, torch.float16
+    if model_id != LLM_MODEL:
+        logger.info(f"🗜️ Loading quantized checkpoint {model_id}")
+    # Conversational + reasoning model (Meta LLaMA), shared by all endpoints
+    pipe = pipeline(
+        "text-generation",
+        model=model_id,
+        token=HF_TOKEN,
+        device=device,
+        torch_dtype=llm_dtype,
+        model_kwargs={"attn_implementation": attn_implementation},
+    )
+    # Batched generation needs a pad token; LLaMA ships without one
+    pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    # Checked after every decode step, so role-play continuations end early
+    llm_stopping_criteria = StoppingCriteriaList([StopStringCriteria(pipe.tokenizer, STOP_SEQUENCES)])
+    logger.info(f"⚡ LLM attention implementation: {pipe.model.config._attn_implementation}")
+    if LLM_DRAFT_MODEL:
+        # The draft proposes several tokens that the 8B model verifies in one
+        # forward pass. Assisted generation needs a dynamic KV cache, so it
+        # replaces the compiled and quantized-cache setups below.
+        logger.info(f"🎯 Loading draft model {LLM_DRAFT_MODEL} for speculative decoding")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            LLM_DRAFT_MODEL, token=HF_TOKEN, torch_dtype=torch_dtype
+        ).to(torch_device).eval()
+    elif LLM_COMPILE and device >= 0 and BATCH_MAX_SIZE == 1:
+        # A static KV cache keeps decode shapes fixed so the step is captured as a
+        # CUDA graph. Micro-batches change the batch size and cache length from
+        # call to call, which would re-capture graphs, so this needs BATCH_MAX_SIZE=1.
+        logger.info("⚙️ Compiling LLM forward pass (reduce-overhead)...")
+        pipe.model.generation_config.cache_implementation = "static"
+        pipe.model.forward = torch.compile(pipe.model.forward, mode="reduce-overhead")
+    elif device >= 0 and importlib.util.find_spec("hqq") is not None:
+        # INT8 KV cache halves the bytes moved per attention step; it cannot be
+        # combined with the static cache used by the compiled path above.
+        pipe.model.generation_config.cache_implementation = "quantized"
+        pipe.model.generation_config.cache_config = {"backend": "HQQ", "nbits": 8}
+    # One short generation pays compile, CUDA graph capture and allocator warmup
+    # before the first real request.
+    with torch.inference_mode():
+        pipe("warmup", max_new_tokens=8)
+    llm_pipe, llm_model_id = pipe, model_id
+
+# Recent greedy generations keyed on a prompt digest; repeated questions skip the model
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+response_cache: OrderedDict = OrderedDict()
+
+# Optional Redis tier so every worker (and restarts) share cached replies
+REDIS_URL = os.getenv("REDIS_URL")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+    logger.info("🧠 Sharing the response cache through Redis")
+
+# ==============================
+# Inference Thread Pool
+# ==============================
+# Model and index calls block for a long time; running them on a bounded pool
+# keeps the event loop free to accept requests while the GPU is busy.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "4"))
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+def call_in_inference_mode(func, *args, **kwargs):
+    """Calls func under torch.inference_mode (grad mode is per-thread, so pool threads need it too)."""
+    with torch.inference_mode():
+        return func(*args, **kwargs)
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking model or index call on the inference thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        inference_executor, functools.partial(call_in_inference_mode, func, *args, **kwargs)
+    )
+
+# Every llm_pipe call (batched, assisted or streamed) runs on this single
+# thread: the static KV cache and CUDA graphs of the compiled model belong to
+# one generate call at a time.
+llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+
+async def run_llm(*args, **kwargs):
+    """Runs llm_pipe on the dedicated LLM thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        llm_executor, functools.partial(call_in_inference_mode, llm_pipe, *args, **kwargs)
+    )
+
+# ==============================
+# Micro-Batching (in-process LLM)
+# ==============================
+# Decode is bound by weight bandwidth, so one generate call over K prompts costs
+# about as much per step as a single prompt. Prompts arriving within a short
+# window are coalesced into one batched pipeline call.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "32"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+pending_generations: asyncio.Queue = asyncio.Queue()
+
+async def collect_batch(queue: asyncio.Queue) -> list:
+    """Waits for one item, then gathers whatever else arrives within the batching window."""
+    batch = [await queue.get()]
+    await asyncio.sleep(BATCH_MAX_WAIT_MS / 1000)
+    while len(batch) < BATCH_MAX_SIZE and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+async def generation_batcher():
+    """Drains queued prompts and runs them through llm_pipe in batches."""
+    while True:
+        batch = await collect_batch(pending_generations)
+
+        # Only prompts with the same sampling settings can share a generate call
+        groups = {}
+        for messages, gen_kwargs, future in batch:
+            groups.setdefault(tuple(sorted(gen_kwargs.items())), []).append((messages, future))
+
+        for gen_kwargs, items in groups.items():
+            # Requests that already timed out are not worth decoding
+            items = [(messages, future) for messages, future in items if not future.done()]
+            if not items:
+                continue
+            conversations = [messages for messages, _ in items]
+            gen_kwargs = dict(gen_kwargs)
+            try:
+                if draft_model is not None and not gen_kwargs["do_sample"]:
+                    # Assisted generation decodes one sequence at a time
+                    outputs = await asyncio.gather(*(
+                        run_llm(
+                            messages, assistant_model=draft_model, truncation=True,
+                            stopping_criteria=llm_stopping_criteria, **gen_kwargs,
+                        )
+                        for messages in conversations
+                    ))
+                else:
+                    outputs = await run_llm(
+                        conversations, batch_size=len(conversations), truncation=True,
+                        stopping_criteria=llm_stopping_criteria, **gen_kwargs,
+                    )
+                for (_, future), output in zip(items, outputs):
+                    if not future.done():
+                        # Chat input returns the whole conversation; the reply is the last message
+                        future.set_result(strip_stop_sequences(output[0]["generated_text"][-1]["content"]))
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+# ==============================
+# Vision Pipeline
+# ==============================
+# Uploads larger than this are rejected before decoding
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))
+ALLOWED_IMAGE_TYPES = {"image/jpeg", "image/png"}
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# ConvNeXt resizes to 224 px anyway, so decode no larger than this
+VISION_DECODE_SIZE = (256, 256)
+# Low-detail image budget for the vision-LLM path
+VLM_IMAGE_SIZE = (336, 336)
+
+# Lightweight Meta Vision backbone (ConvNeXt-Tiny); not needed when the
+# vision-LLM server diagnoses images, which keeps web workers model-free.
+VISION_MODEL = "facebook/convnext-tiny-224"
+
+# libvips decodes CPU-side uploads faster than PIL when installed (optional)
+pyvips = importlib.import_module("pyvips") if importlib.util.find_spec("pyvips") else None
+vision_processor = None
+vision_model = None
+gpu_vision_transform = None
+
+def load_vision_model():
+    """Loads ConvNeXt and, on GPU, the matching on-device preprocessing."""
+    global vision_processor, vision_model, gpu_vision_transform
+    processor = AutoImageProcessor.from_pretrained(VISION_MODEL, token=HF_TOKEN)
+    model = AutoModelForImageClassification.from_pretrained(
+        VISION_MODEL, token=HF_TOKEN, torch_dtype=torch_dtype
+    )
+    model = model.to(torch_device).eval()
+    if LLM_COMPILE and device >= 0:
+        model = torch.compile(model, dynamic=True)
+    crop_size = processor.size["shortest_edge"]
+    with torch.inference_mode():
+        model(pixel_values=torch.zeros(1, 3, crop_size, crop_size, device=torch_device, dtype=model.dtype))
+
+    # On GPU, JPEG uploads are decoded with nvJPEG and preprocessed on-device,
+    # mirroring the ConvNeXt image processor (resize, center crop, normalize).
+    if device >= 0:
+        gpu_vision_transform = v2.Compose([
+            v2.Resize(int(crop_size / processor.crop_pct), antialias=True),
+            v2.CenterCrop(crop_size),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(processor.image_mean, processor.image_std),
+        ])
+    vision_processor, vision_model = processor, model
+
+# ==============================
+# Micro-Batching (vision)
+# ==============================
+# ConvNeXt is compute-bound, so concurrent uploads are stacked into one forward
+# pass instead of running one small launch per image.
+pending_images: asyncio.Queue = asyncio.Queue()
+
+def classify_pixel_batch(batch: list[torch.Tensor]) -> list[dict]:
+    """Runs ConvNeXt once over a batch of preprocessed images (called via run_blocking)."""
+    pixel_values = torch.stack([pixels.to(torch_device, vision_model.dtype) for pixels in batch])
+    probs = vision_model(pixel_values=pixel_values).logits.float().softmax(-1)
+    scores, indices = probs.max(-1)
+    id2label = vision_model.config.id2label
+    return [{"label": id2label[i], "score": score} for score, i in zip(scores.tolist(), indices.tolist())]
+
+async def vision_batcher():
+    """Drains queued images and classifies them in batches."""
+    while True:
+        batch = await collect_batch(pending_images)
+        try:
+            results = await run_blocking(classify_pixel_batch, [pixels for pixels, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+# ==============================
+# Micro-Batching (vector search)
+# ==============================
+# /vector-search and the crop doctor both embed short queries; concurrent ones
+# share one MiniLM forward pass and one FAISS search.
+pending_queries: asyncio.Queue = asyncio.Queue()
+
+async def vector_query_batcher():
+    """Drains queued knowledge-base queries and searches them in batches."""
+    while True:
+        batch = await collect_batch(pending_queries)
+        try:
+            results = await run_blocking(query_vectors, [query for query, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+async def search_knowledge(query: str) -> list[str]:
+    """Top knowledge-base passages for a query, via the vector micro-batcher."""
+    future = asyncio.get_running_loop().create_future()
+    await pending_queries.put((query, future))
+    return await asyncio.wait_for(future, LLM_TIMEOUT)
+
+# ==============================
+# Model Loading
+# ==============================
+# Weights load in background threads after startup, so the health check answers
+# immediately and workers don't block on import. Model-backed routes wait on
+# models_ready through the require_models dependency.
+models_ready = asyncio.Event()
+model_load_error: Exception | None = None
+
+async def load_models():
+    global model_load_error
+    # The knowledge base is also loaded lazily on first query; loading it here
+    # keeps that cost off the first request
+    loaders = [asyncio.to_thread(get_encoder), asyncio.to_thread(get_vector_store)]
+    if llm_client is None:
+        loaders.append(asyncio.to_thread(load_llm))
+    if vlm_client is None:
+        loaders.append(asyncio.to_thread(load_vision_model))
+    try:
+        await asyncio.gather(*loaders)
+        logger.info("✅ Models loaded.")
+    except Exception as e:
+        logger.error(f"Model loading failed: {e}")
+        model_load_error = e
+    models_ready.set()
+
+async def require_models():
+    """Waits until the in-process models are loaded; 503 if loading failed."""
+    await models_ready.wait()
+    if model_load_error is not None:
+        raise HTTPException(status_code=503, detail=f"Models failed to load: {model_load_error}")
 
 # ==============================
 # Helper Functions
 # ==============================
-def run_conversational(pipe, prompt: str):
+# Per-endpoint generation settings. Decode cost grows with every generated token,
+# so budgets stay tight. Extractive and advisory endpoints decode greedily so their replies can be cached.
+CHAT_PARAMS = {"max_new_tokens": 128, "temperature": 0.7, "do_sample": True}
+DISASTER_PARAMS = {"max_new_tokens": 200, "temperature": 0.0, "do_sample": False}
+MARKET_PARAMS = {"max_new_tokens": 96, "temperature": 0.0, "do_sample": False}
+CROP_PARAMS = {"max_new_tokens": 250, "temperature": 0.0, "do_sample": False}
+# Stop role-play continuations early; the chat template's end-of-turn token
+# already ends normal replies on both backends.
+STOP_SEQUENCES = ["\nFarmer:", "\nUser:"]
+
+class StopOnEvent(StoppingCriteria):
+    """Ends generation once the event is set (e.g. the streaming client disconnected)."""
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def strip_stop_sequences(text: str) -> str:
+    """Cuts a reply at the first stop sequence (the in-process backend keeps it)."""
+    for stop in STOP_SEQUENCES:
+        text = text.split(stop, 1)[0]
+    return text.strip()
+
+def stop_prefix_len(text: str) -> int:
+    """Length of the longest tail of text that could be the start of a stop sequence."""
+    return max(
+        (n for stop in STOP_SEQUENCES for n in range(1, len(stop)) if text.endswith(stop[:n])),
+        default=0,
+    )
+
+# Each endpoint's fixed instructions go in a system message ahead of the user
+# text. Keeping them as module-level constants makes every request of an
+# endpoint share byte-identical leading tokens, so the LLM server's prefix
+# cache can reuse their KV entries instead of prefilling them again.
+SYSTEM_CHAT = (
+    "You are AgriCopilot, an assistant for farmers. "
+    "Answer in the same language the farmer writes in, with short, practical advice."
+)
+SYSTEM_DISASTER = (
+    "You are AgriCopilot's disaster response assistant. Summarize the report for farmers: "
+    "what happened, where, who is affected, and the immediate safety steps to take."
+)
+SYSTEM_MARKET = (
+    "You are AgriCopilot's marketplace advisor. For the product given, give a short "
+    "recommendation on pricing, demand, and where farmers can buy or sell it."
+)
+SYSTEM_CROP = (
+    "You are AgriCopilot's crop doctor. Generate a structured diagnostic report with:\n"
+    "1. Disease Name\n2. Cause\n3. Treatment\n4. Prevention Tips\n"
+    "Keep the explanation short and easy for farmers to understand."
+)
+
+async def require_crop_image(image: UploadFile = File(...)) -> UploadFile:
+    """Rejects uploads that are not JPEG or PNG images."""
+    if image.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(status_code=415, detail="Image must be JPEG or PNG")
+    return image
+
+async def read_upload(upload: UploadFile, limit: int) -> bytearray:
+    """Reads an upload in chunks, rejecting it with 413 as soon as it exceeds limit bytes."""
+    # A bytearray is handed to the decoders as-is (no getvalue() copy) and is
+    # writable, so nvJPEG can wrap it with torch.frombuffer without another copy.
+    buffer = bytearray()
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        if len(buffer) + len(chunk) > limit:
+            raise HTTPException(status_code=413, detail="Image too large")
+        buffer += chunk
+    return buffer
+
+def load_crop_image(image_bytes: bytes, size: tuple[int, int] = VISION_DECODE_SIZE) -> Image.Image:
+    """Decodes an upload at reduced size; JPEGs are scaled down inside the DCT decode."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    image.thumbnail(size, Image.BILINEAR)
+    return image
+
+def encode_vlm_image(image_bytes: bytes) -> str:
+    """Downsizes an upload to the vision-LLM budget and returns it as base64 JPEG."""
+    buffer = io.BytesIO()
+    load_crop_image(image_bytes, VLM_IMAGE_SIZE).save(buffer, format="JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+def decode_crop_pixels_vips(image_bytes: bytes):
+    """Decodes an upload with libvips shrink-on-load into an RGB uint8 array."""
+    image = pyvips.Image.thumbnail_buffer(image_bytes, VISION_DECODE_SIZE[0], height=VISION_DECODE_SIZE[1])
+    if image.hasalpha():
+        image = image.flatten()
+    if image.interpretation != "srgb":
+        image = image.colourspace("srgb")
+    return image.numpy()
+
+def preprocess_crop_image(image_bytes: bytes) -> torch.Tensor:
+    """Turns an upload into ConvNeXt pixel values, decoding JPEGs on the GPU when available."""
+    if gpu_vision_transform is not None and image_bytes[:2] == b"\xff\xd8":
+        data = torch.frombuffer(image_bytes, dtype=torch.uint8)
+        return gpu_vision_transform(decode_jpeg(data, mode=ImageReadMode.RGB, device=torch_device))
+    image = decode_crop_pixels_vips(image_bytes) if pyvips is not None else load_crop_image(image_bytes)
+    return vision_processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+async def classify_crop_image(image_bytes: bytes) -> list[dict]:
+    """Classifies an upload with ConvNeXt via the vision micro-batcher."""
+    pixel_values = await run_blocking(preprocess_crop_image, image_bytes)
+    future = asyncio.get_running_loop().create_future()
+    await pending_images.put((pixel_values, future))
+    return [await asyncio.wait_for(future, LLM_TIMEOUT)]
+
+def chat_messages(system: str, user: str) -> list[dict]:
+    """Builds a system + user conversation for the chat template."""
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+def chat_completion_payload(messages: list[dict], max_new_tokens: int, temperature: float, do_sample: bool) -> dict:
+    """Builds an OpenAI-style chat completion request for the LLM server."""
+    return {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "max_tokens": max_new_tokens,
+        "temperature": temperature if do_sample else 0.0,
+        "stop": STOP_SEQUENCES,
+    }
+
+async def generate_text(system: str, user: str, max_new_tokens: int, temperature: float, do_sample: bool) -> str:
+    """Returns a cached greedy generation for this prompt, or runs a new one."""
+    messages = chat_messages(system, user)
+    if do_sample:
+        # Sampled replies are meant to vary, so only greedy generations are cached
+        return await _generate_uncached(messages, max_new_tokens, temperature, do_sample)
+
+    digest = hashlib.blake2b(f"{llm_model_id}\0{system}\0{user}".encode(), digest_size=16).hexdigest()
+    key = f"agricopilot:reply:{digest}:{max_new_tokens}"
+    text = await cached_reply(key)
+    if text is None:
+        text = await _generate_uncached(messages, max_new_tokens, temperature, do_sample)
+        await remember_reply(key, text)
+    return text
+
+async def cached_reply(key: str) -> str | None:
+    """Looks a reply up in the local LRU, then in the shared Redis tier."""
+    if key in response_cache:
+        response_cache.move_to_end(key)
+        return response_cache[key]
+    text = await shared_cache_get(key)
+    if text is not None:
+        remember_locally(key, text)
+    return text
+
+async def remember_reply(key: str, text: str):
+    """Stores a reply in the local LRU and the shared Redis tier."""
+    remember_locally(key, text)
+    await shared_cache_set(key, text)
+
+def remember_locally(key: str, text: str):
+    response_cache[key] = text
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+async def shared_cache_get(key: str) -> str | None:
+    """Reads a reply from Redis; a cache outage just means a miss."""
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(key)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis read failed: {e}")
+        return None
+
+async def shared_cache_set(key: str, text: str):
+    """Stores a reply in Redis for RESPONSE_CACHE_TTL seconds."""
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(key, text, ex=RESPONSE_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis write failed: {e}")
+
+async def _generate_uncached(messages: list[dict], max_new_tokens: int, temperature: float, do_sample: bool) -> str:
+    """Runs one generation on the configured LLM backend and returns the text."""
+    if llm_client is not None:
+        payload = chat_completion_payload(messages, max_new_tokens, temperature, do_sample)
+        response = await llm_client.post("/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"].strip()
+
+    future = asyncio.get_running_loop().create_future()
+    gen_kwargs = {"max_new_tokens": max_new_tokens, "temperature": temperature, "do_sample": do_sample}
+    await pending_generations.put((messages, gen_kwargs, future))
+    # A stuck batch fails this request instead of hanging it forever
+    return await asyncio.wait_for(future, LLM_TIMEOUT)
+
+async def stream_text(system: str, user: str, max_new_tokens: int, temperature: float, do_sample: bool):
+    """
+    Yields generated text fragments as soon as they are decoded.
+    In-process streams are single-sequence generate calls on the LLM thread, so
+    each one holds up the micro-batcher and concurrent streams decode one after
+    another; set LLM_SERVER_URL to stream at scale.
+    """
+    messages = chat_messages(system, user)
+    if llm_client is not None:
+        payload = chat_completion_payload(messages, max_new_tokens, temperature, do_sample)
+        payload["stream"] = True
+        async with llm_client.stream("POST", "/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                fragment = json.loads(line[len("data: "):])["choices"][0]["delta"].get("content")
+                if fragment:
+                    yield fragment
+        return
+
+    # Streaming bypasses the micro-batcher but queues on the same LLM thread;
+    # generate pushes decoded text into the streamer as each token is produced.
+    streamer = TextIteratorStreamer(
+        llm_pipe.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=LLM_TIMEOUT
+    )
+    # Set when the client goes away, so generate stops at the next decode step
+    cancelled = threading.Event()
+    stopping_criteria = StoppingCriteriaList([*llm_stopping_criteria, StopOnEvent(cancelled)])
+    gen_kwargs = {"max_new_tokens": max_new_tokens, "temperature": temperature, "do_sample": do_sample}
+    generation = asyncio.ensure_future(
+        run_llm(messages, streamer=streamer, stopping_criteria=stopping_criteria, **gen_kwargs)
+    )
+    # A failed generate never ends the streamer; end it so the reader below wakes up
+    def end_on_failure(task):
+        if task.cancelled() or task.exception() is not None:
+            streamer.end()
+    generation.add_done_callback(end_on_failure)
+    loop = asyncio.get_running_loop()
+    # Generate stops after a stop sequence but still decodes it, so text that may
+    # be the start of one is held back until the next fragment settles it
+    pending = ""
+
+    def next_fragment():
+        try:
+            return next(streamer, None)
+        except queue.Empty:
+            raise TimeoutError(
+                f"No tokens within {LLM_TIMEOUT:.0f}s; the in-process LLM queue is busy"
+            ) from None
+
+    try:
+        while (fragment := await loop.run_in_executor(None, next_fragment)) is not None:
+            pending += fragment
+            stop_at = min((i for i in (pending.find(stop) for stop in STOP_SEQUENCES) if i >= 0), default=-1)
+            if stop_at >= 0:
+                if pending[:stop_at]:
+                    yield pending[:stop_at]
+                return
+            ready = len(pending) - stop_prefix_len(pending)
+            if ready:
+                yield pending[:ready]
+                pending = pending[ready:]
+        if pending:
+            yield pending
+        await generation
+    finally:
+        cancelled.set()
+
+def sse_response(fragments) -> StreamingResponse:
+    """Wraps a text-fragment async generator as a Server-Sent Events response."""
+    async def events():
+        try:
+            async for fragment in fragments:
+                yield f"data: {json.dumps(fragment)}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"Streaming generation error: {e}")
+            yield f"event: error\ndata: {json.dumps(f'⚠️ Model error: {str(e)}')}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def with_token_cap(params: dict, max_tokens: int | None) -> dict:
+    """Applies a request's max_tokens, never above the endpoint's own budget."""
+    if max_tokens is None or max_tokens >= params["max_new_tokens"]:
+        return params
+    return {**params, "max_new_tokens": max_tokens}
+
+async def run_conversational(system: str, prompt: str, params: dict):
     """Handles conversational tasks safely."""
     try:
-        output = pipe(prompt, max_new_tokens=200, temperature=0.7, do_sample=True)
-        if isinstance(output, list) and len(output) > 0:
-            return output[0].get("generated_text", str(output))
-        return str(output)
+        return await generate_text(system, prompt, **params)
     except Exception as e:
         logger.error(f"Conversational pipeline error: {e}")
         return f"⚠️ Model error: {str(e)}"
 
-def run_crop_doctor(image_bytes: bytes, symptoms: str):
+async def diagnose_with_vlm(image_b64: str, symptoms: str, related_knowledge: str) -> str:
+    """Runs the crop diagnosis as one vision-LLM call on the image itself."""
+    prompt = (
+        SYSTEM_CROP
+        + "\n\nA farmer uploaded this crop image. "
+        f"Reported symptoms: {symptoms}. "
+        f"Knowledge base reference: {related_knowledge}."
+    )
+    payload = {
+        "model": VLM_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}", "detail": "low"}},
+                {"type": "text", "text": prompt},
+            ],
+        }],
+        "max_tokens": CROP_PARAMS["max_new_tokens"],
+        "temperature": 0.0,
+    }
+    response = await vlm_client.post("/chat/completions", json=payload)
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+async def run_crop_doctor(image_bytes: bytes, symptoms: str):
     """
-    Hybrid Crop Doctor System:
-    1. Uses ConvNeXt to classify plant visuals.
-    2. Pulls related info from vector dataset.
-    3. LLaMA 3.1 generates a short diagnosis and treatment guide.
+    Crop Doctor System:
+    1. Pulls related info from vector dataset.
+    2. With a vision-LLM server configured, diagnoses from the image in one call.
+    3. Otherwise, ConvNeXt classifies the plant visuals and LLaMA 3.1
+       generates a short diagnosis and treatment guide.
     """
+    # Farmers often resubmit the same photo; identical image + symptoms reuse the diagnosis
+    image_digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    symptoms_digest = hashlib.blake2b(" ".join(symptoms.lower().split()).encode(), digest_size=8).hexdigest()
+    models = VLM_MODEL if vlm_client is not None else f"{VISION_MODEL}\0{llm_model_id}"
+    models_digest = hashlib.blake2b(models.encode(), digest_size=8).hexdigest()
+    key = f"agricopilot:crop:{models_digest}:{image_digest}:{symptoms_digest}"
     try:
-        # --- Step 1: Vision Classification ---
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        vision_results = crop_vision(image)
-        if not vision_results or "label" not in vision_results[0]:
-            raise ValueError("No vision classification result received.")
-        top_label = vision_results[0]["label"]
-
-        # --- Step 2: Vector Knowledge Recall ---
-        vector_matches = query_vector(symptoms)
-        related_knowledge = " ".join(vector_matches[:3]) if isinstance(vector_matches, list) else str(vector_matches)
+        cached = await cached_reply(key)
+        if cached is not None:
+            return cached
 
-        # --- Step 3: Reasoning via LLaMA ---
-        prompt = (
-            f"A farmer uploaded a maize image showing signs of '{top_label}'. "
-            f"Reported symptoms: {symptoms}. "
-            f"Knowledge base reference: {related_knowledge}. "
-            "Generate a structured diagnostic report with:\n"
-            "1. Disease Name\n2. Cause\n3. Treatment\n4. Prevention Tips\n"
-            "Keep the explanation short and easy for farmers to understand."
+        # --- Step 1: Vector Knowledge Recall (concurrent with the image work) ---
+        image_task = (
+            run_blocking(encode_vlm_image, image_bytes) if vlm_client is not None
+            else classify_crop_image(image_bytes)
         )
+        vector_matches, image_result = await asyncio.gather(search_knowledge(symptoms), image_task)
+        related_knowledge = " ".join(vector_matches[:3]) if isinstance(vector_matches, list) else str(vector_matches)
+
+        if vlm_client is not None:
+            # --- Step 2: Vision-LLM Diagnosis ---
+            text = await diagnose_with_vlm(image_result, symptoms, related_knowledge)
+        else:
+            # --- Step 3: ConvNeXt Classification ---
+            vision_results = image_result
+            if not vision_results or "label" not in vision_results[0]:
+                raise ValueError("No vision classification result received.")
+            top_label = vision_results[0]["label"]
 
-        response = chat_pipe(prompt, max_new_tokens=250, temperature=0.6, do_sample=False, truncation=True)
+            # --- Step 3 (cont.): Reasoning via LLaMA ---
+            prompt = (
+                f"A farmer uploaded a maize image showing signs of '{top_label}'. "
+                f"Reported symptoms: {symptoms}. "
+                f"Knowledge base reference: {related_knowledge}."
+            )
+            text = await generate_text(SYSTEM_CROP, prompt, **CROP_PARAMS)
 
-        # Extract text output
-        if isinstance(response, list) and len(response) > 0:
-            text = response[0].get("generated_text", "").strip()
-            return text if text else "⚠️ No response generated. Try again with clearer image or symptoms."
-        return "⚠️ Unexpected response format from reasoning model."
+        if not text:
+            return "⚠️ No response generated. Try again with clearer image or symptoms."
+        await remember_reply(key, text)
+        return text
 
     except Exception as e:
         logger.error(f"Crop Doctor error: {e}")
@@ -171,41 +871,46 @@ def run_crop_doctor(image_bytes: bytes, symptoms: str):
 # ==============================
 # Endpoints
 # ==============================
-@app.post("/crop-doctor")
+@app.post("/crop-doctor", dependencies=[Depends(require_auth), Depends(require_models)])
 async def crop_doctor(
-    symptoms: str = Header(...),
-    image: UploadFile = File(...),
-    authorization: str | None = Header(None)
+    form: CropDoctorForm = Depends(CropDoctorForm.as_form),
+    image: UploadFile = Depends(require_crop_image),
 ):
     """Diagnose crop disease from image and text."""
-    check_auth(authorization)
-    image_bytes = await image.read()
-    diagnosis = run_crop_doctor(image_bytes, symptoms)
+    if image.size is not None and image.size > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    image_bytes = await read_upload(image, MAX_IMAGE_BYTES)
+    diagnosis = await run_crop_doctor(image_bytes, form.symptoms)
     return {"diagnosis": diagnosis}
 
-@app.post("/multilingual-chat")
-async def multilingual_chat(req: ChatRequest, authorization: str | None = Header(None)):
-    check_auth(authorization)
-    reply = run_conversational(chat_pipe, req.query)
+@app.post("/multilingual-chat", dependencies=[Depends(require_auth), Depends(require_models)])
+async def multilingual_chat(req: ChatRequest):
+    params = with_token_cap(CHAT_PARAMS, req.max_tokens)
+    if req.stream:
+        return sse_response(stream_text(SYSTEM_CHAT, req.query, **params))
+    reply = await run_conversational(SYSTEM_CHAT, req.query, params)
     return {"reply": reply}
 
-@app.post("/disaster-summarizer")
-async def disaster_summarizer(req: DisasterRequest, authorization: str | None = Header(None)):
-    check_auth(authorization)
-    summary = run_conversational(disaster_pipe, req.report)
+@app.post("/disaster-summarizer", dependencies=[Depends(require_auth), Depends(require_models)])
+async def disaster_summarizer(req: DisasterRequest):
+    params = with_token_cap(DISASTER_PARAMS, req.max_tokens)
+    if req.stream:
+        return sse_response(stream_text(SYSTEM_DISASTER, req.report, **params))
+    summary = await run_conversational(SYSTEM_DISASTER, req.report, params)
     return {"summary": summary}
 
-@app.post("/marketplace")
-async def marketplace(req: MarketRequest, authorization: str | None = Header(None)):
-    check_auth(authorization)
-    recommendation = run_conversational(market_pipe, req.product)
+@app.post("/marketplace", dependencies=[Depends(require_auth), Depends(require_models)])
+async def marketplace(req: MarketRequest):
+    params = with_token_cap(MARKET_PARAMS, req.max_tokens)
+    if req.stream:
+        return sse_response(stream_text(SYSTEM_MARKET, req.product, **params))
+    recommendation = await run_conversational(SYSTEM_MARKET, req.product, params)
     return {"recommendation": recommendation}
 
-@app.post("/vector-search")
-async def vector_search(req: VectorRequest, authorization: str | None = Header(None)):
-    check_auth(authorization)
+@app.post("/vector-search", dependencies=[Depends(require_auth)])
+async def vector_search(req: VectorRequest):
     try:
-        results = query_vector(req.query)
+        results = await search_knowledge(req.query)
         return {"results": results}
     except Exception as e:
         logger.error(f"Vector search error: {e}")
@@ -43,7 +43,10 @@ crisis_df = pd.DataFrame(crisis["train"])
 if "tweet_text" in crisis_df.columns:
     crisis_df["text"] = crisis_df["tweet_text"].astype(str)
 else:
-    crisis_df["text"] = crisis_df.astype(str).agg(" ".join, axis=1)
+    # Column-wise string concatenation; a row-wise agg boxes every row.
+    # Missing cells are blanked first so they cannot turn a whole row into NaN.
+    columns = crisis_df.fillna("").astype(str)
+    crisis_df["text"] = columns.iloc[:, 0].str.cat(columns.iloc[:, 1:], sep=" ")
 
 crisis_df[["text"]].to_csv("datasets/crisis.csv", index=False)
 print("✅ Saved CrisisNLP -> datasets/crisis.csv")
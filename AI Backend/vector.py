@@ -1,17 +1,40 @@
 # vector.py
 import os
 import glob
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+import faiss
+import numpy as np
 import pandas as pd
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import torch
+from sentence_transformers import SentenceTransformer
 
 # ==============================
 # CONFIGURATION
 # ==============================
 VECTOR_PATH = "faiss_index"
+INDEX_FILE = os.path.join(VECTOR_PATH, "index.faiss")
+TEXTS_FILE = os.path.join(VECTOR_PATH, "texts.json")
+VECTORS_FILE = os.path.join(VECTOR_PATH, "vectors.npy")
+MANIFEST_FILE = os.path.join(VECTOR_PATH, "manifest.json")
+CSV_CHUNK_ROWS = 4096
 HF_CACHE_DIR = os.getenv("HF_CACHE_DIR", "/app/huggingface_cache")
 EMBEDDING_MODEL = os.getenv("HF_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 HF_TOKEN = os.getenv("HUGGINGFACEHUB_API_TOKEN")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "256"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+HNSW_EF_CONSTRUCTION = 200
+IVFPQ_MIN_VECTORS = int(os.getenv("IVFPQ_MIN_VECTORS", "200000"))
+IVFPQ_NLIST = 1024
+IVFPQ_NPROBE = int(os.getenv("IVFPQ_NPROBE", "16"))
+
+logger = logging.getLogger("AgriCopilot.vector")
 
 # Ensure cache directory exists
 os.makedirs(HF_CACHE_DIR, exist_ok=True)
@@ -19,57 +42,332 @@ os.makedirs(HF_CACHE_DIR, exist_ok=True)
 # ==============================
 # EMBEDDING SETUP
 # ==============================
-embeddings = HuggingFaceEmbeddings(
-    model_name=EMBEDDING_MODEL,
-    cache_folder=HF_CACHE_DIR,
-    model_kwargs={"token": HF_TOKEN}
-)
+# One persistent SentenceTransformer; on GPU it runs in fp16, which halves the
+# bytes moved per MiniLM matmul. The model itself L2-normalizes its output.
+# Loaded on first use (see get_encoder), not at import.
+# The device is explicit ("cuda:N"): the current CUDA device is per-thread, and
+# the encoder is loaded and called from pool threads. app.py pins it to the
+# worker's GPU through configure_device.
+EMBED_DEVICE = os.getenv("EMBED_DEVICE", "cuda:0" if torch.cuda.is_available() else "cpu")
+_encoder = None
+_load_lock = threading.RLock()  # reentrant: building the store loads the encoder
+
+
+def configure_device(device: str):
+    """Sets the encoder device; must be called before the encoder is loaded."""
+    global EMBED_DEVICE
+    if "EMBED_DEVICE" not in os.environ:
+        EMBED_DEVICE = device
+
+
+def get_encoder() -> SentenceTransformer:
+    """Returns the shared SentenceTransformer, loading it on first call."""
+    global _encoder
+    if _encoder is None:
+        with _load_lock:
+            if _encoder is None:
+                encoder = SentenceTransformer(
+                    EMBEDDING_MODEL,
+                    device=EMBED_DEVICE,
+                    cache_folder=HF_CACHE_DIR,
+                    token=HF_TOKEN,
+                    model_kwargs={"torch_dtype": torch.float16} if EMBED_DEVICE.startswith("cuda") else None,
+                )
+                _encoder = encoder.eval()
+    return _encoder
+
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+    """Encodes texts into a contiguous float32 matrix, one row per text."""
+    with torch.inference_mode():
+        vecs = get_encoder().encode(texts, batch_size=128, convert_to_numpy=True, show_progress_bar=False)
+    return np.ascontiguousarray(vecs, dtype=np.float32)
 
 # ==============================
 # VECTOR STORE OPERATIONS
 # ==============================
-def build_vectorstore():
-    """Builds FAISS index from all CSV files in /datasets."""
-    texts = []
+def use_ann_index(index):
+    """
+    Swaps a flat (exact, O(N) scan) FAISS index for an approximate one.
+    Large corpora get IVF-PQ, storing 48-byte codes instead of fp32 vectors;
+    smaller ones get an HNSW graph over int8 scalar-quantized vectors (4x
+    smaller than fp32; queries stay fp32 for asymmetric distances).
+    """
+    if isinstance(index, faiss.IndexFlat):
+        # Vectors are re-added in the same order, so ids still match the texts list
+        vectors = index.reconstruct_n(0, index.ntotal)
+        if index.ntotal >= IVFPQ_MIN_VECTORS:
+            pq_m = next(m for m in (48, 32, 16, 8, 4, 2, 1) if index.d % m == 0)
+            ann = faiss.IndexIVFPQ(faiss.IndexFlatL2(index.d), index.d, IVFPQ_NLIST, pq_m, 8)
+            sample = np.random.default_rng(0).permutation(index.ntotal)[: IVFPQ_NLIST * 256]
+            ann.train(vectors[np.sort(sample)])
+        else:
+            ann = faiss.IndexHNSWSQ(index.d, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+            ann.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            # SQ8 training only learns each dimension's value range
+            ann.train(vectors)
+        ann.add(vectors)
+        index = ann
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVFPQ_NPROBE
+    return index
+
+
+def join_columns(df: pd.DataFrame) -> pd.Series:
+    """Joins every column of each row with spaces, column-wise rather than per row."""
+    # Missing cells become "" first: with pandas 3, astype(str) keeps them as
+    # NaN and str.cat would turn the whole row into NaN
+    columns = df.fillna("").astype(str)
+    return columns.iloc[:, 0].str.cat(columns.iloc[:, 1:], sep=" ")
+
+
+def dataset_manifest() -> dict:
+    """Size and mtime of every dataset CSV, used to notice when they change."""
+    manifest = {}
+    for file in sorted(glob.glob("datasets/*.csv")):
+        stat = os.stat(file)
+        manifest[file] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
 
+def _text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _write_atomic(path: str, write):
+    # Per-process temp name: several workers may rebuild at the same time
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_json(path: str, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def _write_npy(path: str, array: np.ndarray):
+    # np.save appends ".npy" to a bare path, so hand it an open file
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+def _read_json(path: str, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+PLACEHOLDER_TEXT = "AgriCopilot initialized knowledge base."
+
+
+def build_vectorstore(vectors: np.ndarray | None = None, texts=None):
+    """
+    Builds FAISS index from all CSV files in /datasets.
+    Given the fp32 vectors and texts of an earlier build, only rows not already
+    indexed are embedded, so growing a dataset does not re-embed everything.
+    The ANN index is still retrained over the combined vectors, so quantizer
+    ranges, IVF centroids and the HNSW-SQ / IVF-PQ choice follow the new data.
+    Rows are never removed this way; load_vector_store does a full rebuild
+    when a dataset shrinks or disappears.
+    """
+    texts = list(texts or [])
+    seen = {_text_hash(text) for text in texts}
+    index = faiss.IndexFlatL2(get_encoder().get_sentence_embedding_dimension())
+    if vectors is not None and len(vectors):
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    added = 0
+
+    def add_texts(chunk_texts: list[str]):
+        nonlocal added
+        new_texts = []
+        for text in chunk_texts:
+            text_hash = _text_hash(text)
+            if text_hash not in seen:
+                seen.add(text_hash)
+                new_texts.append(text)
+        # Texts are only kept once their vectors are in, so ids stay aligned
+        if new_texts:
+            index.add(embed_texts(new_texts))
+            texts.extend(new_texts)
+            added += len(new_texts)
+
+    logger.info("📚 Building FAISS vector index...")
     for file in glob.glob("datasets/*.csv"):
+        rows = 0
         try:
-            df = pd.read_csv(file)
-
-            if "text" in df.columns:
-                # Primary text field
-                texts.extend(df["text"].dropna().astype(str).tolist())
-            else:
-                # Combine all columns if no "text" column found
-                texts.extend([" ".join(map(str, row.values)) for _, row in df.iterrows()])
+            # Read, embed and index one chunk at a time so large datasets never
+            # sit in memory as a whole DataFrame. Everything is read as str
+            # (no type inference), and only the text column when there is one.
+            has_text = "text" in pd.read_csv(file, nrows=0).columns
+            chunks = pd.read_csv(
+                file, chunksize=CSV_CHUNK_ROWS, dtype=str, engine="c",
+                usecols=["text"] if has_text else None,
+            )
+            for df in chunks:
+                if has_text:
+                    # Primary text field
+                    add_texts(df["text"].dropna().tolist())
+                else:
+                    # Combine all columns if no "text" column found
+                    add_texts(join_columns(df).tolist())
+                rows += len(df)
 
-            print(f"✅ Loaded {len(df)} rows from {file}")
+            logger.info("✅ Loaded %d rows from %s", rows, file)
 
         except Exception as e:
-            print(f"⚠️ Skipping {file}, error: {e}")
+            logger.warning("⚠️ Skipping rest of %s after %d rows, error: %s", file, rows, e)
 
     if not texts:
-        texts = ["AgriCopilot initialized knowledge base."]
+        add_texts([PLACEHOLDER_TEXT])
 
-    print("📚 Building FAISS vector index...")
-    vectorstore = FAISS.from_texts(texts, embeddings)
-    vectorstore.save_local(VECTOR_PATH)
-    print(f"🎉 Vectorstore built successfully with {len(texts)} documents.")
+    # The exact vectors are kept next to the ANN index for the next incremental build
+    vectors = index.reconstruct_n(0, index.ntotal)
+    index = use_ann_index(index)
 
-    return vectorstore
+    # Each file is swapped in atomically and the manifest goes last, recording
+    # ntotal: load_vector_store only trusts the set when all files agree, so a
+    # crash or a concurrent writer between the swaps forces a rebuild.
+    os.makedirs(VECTOR_PATH, exist_ok=True)
+    manifest = {"datasets": dataset_manifest(), "ntotal": index.ntotal}
+    _write_atomic(VECTORS_FILE, lambda path: _write_npy(path, vectors))
+    _write_atomic(INDEX_FILE, lambda path: faiss.write_index(index, path))
+    _write_atomic(TEXTS_FILE, lambda path: _write_json(path, texts))
+    _write_atomic(MANIFEST_FILE, lambda path: _write_json(path, manifest))
+    clear_query_cache()
+    logger.info("🎉 Vectorstore built successfully with %d documents (%d newly embedded).", len(texts), added)
+
+    return index, texts
 
 
 def load_vector_store():
-    """Loads FAISS index if it exists, otherwise builds a new one."""
-    if os.path.exists(VECTOR_PATH):
-        print("🔄 Loading existing FAISS index...")
-        return FAISS.load_local(VECTOR_PATH, embeddings, allow_dangerous_deserialization=True)
+    """Loads the FAISS index and its texts if they exist, otherwise builds new ones."""
+    if os.path.exists(INDEX_FILE) and os.path.exists(TEXTS_FILE):
+        manifest = _read_json(MANIFEST_FILE, {})
+        texts = _read_json(TEXTS_FILE)
+        # Read-only with IO_FLAG_MMAP: for IVF-PQ the inverted lists stay
+        # memory-mapped, paged in on demand and shared between workers. FAISS
+        # has no mmap support for HNSW-SQ, so that index (and texts.json) is
+        # still read into each worker's memory.
+        index = faiss.read_index(INDEX_FILE, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        if not manifest.get("ntotal") == index.ntotal == len(texts):
+            logger.warning("⚠️ FAISS index, texts and manifest are out of sync. Rebuilding...")
+            return build_vectorstore()
+        indexed, current = manifest["datasets"], dataset_manifest()
+        if indexed != current:
+            # Appending rows is indexed incrementally; anything that may have
+            # removed rows needs a full rebuild to drop their vectors, and so does
+            # a store holding only the placeholder row
+            vectors = np.load(VECTORS_FILE, mmap_mode="r") if os.path.exists(VECTORS_FILE) else None
+            if vectors is None or len(vectors) != len(texts) or texts == [PLACEHOLDER_TEXT]:
+                logger.info("🔁 Datasets changed since the last build. Rebuilding...")
+                return build_vectorstore()
+            if any(file not in current or current[file][0] < size for file, (size, _) in indexed.items()):
+                logger.info("🔁 Dataset rows were removed since the last build. Rebuilding...")
+                return build_vectorstore()
+            logger.info("🔁 Datasets changed since the last build. Indexing new rows...")
+            return build_vectorstore(vectors, texts)
+        logger.info("🔄 Loading existing FAISS index...")
+        return use_ann_index(index), texts
     else:
-        print("🧩 No existing FAISS index found. Building a new one...")
+        # Also covers indexes saved by the old LangChain store (index.pkl, no texts.json)
+        logger.info("🧩 No existing FAISS index found. Building a new one...")
         return build_vectorstore()
 
 
-vectorstore = load_vector_store()
+# ==============================
+# QUERY CACHE
+# ==============================
+# Farmers repeat the same questions, so results are cached twice: exactly on the
+# normalized query text, and semantically on the query embedding (a recent query
+# with cosine similarity >= SEMANTIC_CACHE_THRESHOLD reuses its results).
+_query_cache: OrderedDict = OrderedDict()  # (normalized query, k) -> results
+_semantic_cache = deque(maxlen=SEMANTIC_CACHE_SIZE)  # (unit embedding, k, results)
+_cache_lock = threading.Lock()
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _semantic_lookup(unit_vec: np.ndarray, k: int):
+    with _cache_lock:
+        entries = list(_semantic_cache)
+    if not entries:
+        return None
+    sims = np.stack([vec for vec, _, _ in entries]) @ unit_vec
+    best = int(sims.argmax())
+    _, cached_k, results = entries[best]
+    if sims[best] >= SEMANTIC_CACHE_THRESHOLD and cached_k == k:
+        return results
+    return None
+
+
+def _cached_results(key):
+    with _cache_lock:
+        if key in _query_cache:
+            _query_cache.move_to_end(key)
+            return _query_cache[key]
+    return None
+
+
+def _remember(key, unit_vec, results):
+    with _cache_lock:
+        _query_cache[key] = results
+        if len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+        if unit_vec is not None:
+            _semantic_cache.append((unit_vec, key[1], results))
+
+
+def _search_batch(queries: list[str], k: int) -> list[tuple[str, ...]]:
+    """Answers normalized queries from the caches, embedding and searching the misses together."""
+    found = {q: _cached_results((q, k)) for q in dict.fromkeys(queries)}
+    misses = [q for q, results in found.items() if results is None]
+    if misses:
+        # One encoder forward pass and one index search for every uncached query
+        vecs = embed_texts(misses)
+        unit_vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+
+        to_search = []
+        for i, query in enumerate(misses):
+            results = _semantic_lookup(unit_vecs[i], k)
+            if results is not None:
+                found[query] = results
+                _remember((query, k), None, results)
+            else:
+                to_search.append(i)
+
+        if to_search:
+            index, texts = get_vector_store()
+            _, ids = index.search(vecs[to_search], k)
+            for i, row in zip(to_search, ids):
+                results = tuple(texts[j] for j in row if j != -1)
+                found[misses[i]] = results
+                _remember((misses[i], k), unit_vecs[i], results)
+    return [found[q] for q in queries]
+
+def clear_query_cache():
+    """Drops cached results; they refer to the previous index."""
+    with _cache_lock:
+        _query_cache.clear()
+        _semantic_cache.clear()
+
+
+_vector_store = None  # (index, texts), loaded on first use
+
+
+def get_vector_store():
+    """Returns (index, texts), loading or building them on first call."""
+    global _vector_store
+    if _vector_store is None:
+        with _load_lock:
+            if _vector_store is None:
+                _vector_store = load_vector_store()
+    return _vector_store
 
 # ==============================
 # VECTOR QUERY
@@ -79,9 +377,13 @@ def query_vector(query: str, k: int = 3):
     Performs a semantic similarity search using FAISS.
     Returns a list of top-k relevant text chunks from the knowledge base.
     """
+    return query_vectors([query], k)[0]
+
+
+def query_vectors(queries: list[str], k: int = 3):
+    """Batched query_vector: one embedding pass and one FAISS search for all queries."""
     try:
-        docs = vectorstore.similarity_search(query, k=k)
-        return [d.page_content for d in docs]
+        return [list(results) for results in _search_batch([_normalize_query(q) for q in queries], k)]
     except Exception as e:
-        print(f"⚠️ Vector query error: {e}")
-        return ["No relevant knowledge found."]
+        logger.error("⚠️ Vector query error: %s", e)
+        return [["No relevant knowledge found."] for _ in queries]